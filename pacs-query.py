@@ -3,9 +3,16 @@
 import os
 import sys
 import time
+import shutil
+import sqlite3
+import tempfile
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 import httpx
-from pyorthanc import Orthanc, Study
+import ijson
+import pydicom
+from pyorthanc import Orthanc
 
 # --- Configuration ---
 # URL of your Orthanc Server's REST API
@@ -19,20 +26,75 @@ QUERY_WINDOW = timedelta(minutes=60)
 # Directory to save the retrieved DICOM files
 DOWNLOAD_DIR = 'retrieved_studies'
 
-# A simple file-based database to track which studies have been processed.
-PROCESSED_UIDS_FILE = 'processed_study_uids.txt'
+# Size of the userspace buffer used when writing extracted DICOM files.
+WRITE_BUFFER_SIZE = 1 << 20
+
+# Number of threads extracting members of a study archive in parallel.
+EXTRACT_WORKERS = 8
+
+# SQLite database used to track which studies have been processed.
+PROCESSED_DB_FILE = 'processed.db'
+
+# Number of completed studies recorded per database commit. Commits are
+# batched to amortize the sync cost; at most this many completions need to
+# be redone if the run is interrupted.
+PROCESSED_COMMIT_INTERVAL = 16
+
+# Plain-text tracking file used by earlier versions; imported once if present.
+LEGACY_PROCESSED_UIDS_FILE = 'processed_study_uids.txt'
+
+class Processed:
+    """Set-like view of the processed Study Instance UIDs stored in SQLite."""
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS processed(uid TEXT PRIMARY KEY, ts INTEGER) WITHOUT ROWID'
+        )
+
+    def __contains__(self, uid):
+        return self.conn.execute('SELECT 1 FROM processed WHERE uid=?', (uid,)).fetchone() is not None
+
+    def add(self, uid):
+        """Records a processed UID. The change is persisted on the next commit()."""
+        self.conn.execute('INSERT OR IGNORE INTO processed VALUES(?, ?)', (uid, int(time.time())))
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
 
 def load_processed_uids():
-    """Loads the set of already processed Study Instance UIDs from a file."""
-    if not os.path.exists(PROCESSED_UIDS_FILE):
-        return set()
-    with open(PROCESSED_UIDS_FILE, 'r') as f:
-        return {line.strip() for line in f if line.strip()}
+    """Opens the processed-study database, importing the legacy text file if present."""
+    processed = Processed(PROCESSED_DB_FILE)
+    if os.path.exists(LEGACY_PROCESSED_UIDS_FILE):
+        with open(LEGACY_PROCESSED_UIDS_FILE, 'r') as f:
+            for line in f:
+                if line.strip():
+                    processed.add(line.strip())
+        processed.commit()
+        os.rename(LEGACY_PROCESSED_UIDS_FILE, LEGACY_PROCESSED_UIDS_FILE + '.imported')
+    return processed
 
-def save_processed_uid(uid):
-    """Appends a new processed Study Instance UID to our tracking file."""
-    with open(PROCESSED_UIDS_FILE, 'a') as f:
-        f.write(uid + '\n')
+def _iter_find(client, query):
+    """
+    Posts a query to /tools/find and yields the results one at a time while
+    the response is still being received, instead of parsing the whole list.
+    """
+    results = ijson.sendable_list()
+    parser = ijson.items_coro(results, 'item')
+    with client.stream('POST', f"{ORTHANC_URL}/tools/find", json=query) as response:
+        response.raise_for_status()
+        for chunk in response.iter_bytes():
+            parser.send(chunk)
+            yield from results
+            del results[:]
+    parser.close()
+    yield from results
 
 def query_for_new_studies(client, processed_uids):
     """
@@ -43,67 +105,102 @@ def query_for_new_studies(client, processed_uids):
     print("Querying Orthanc for new studies...")
     now = datetime.now()
     start_time = now - QUERY_WINDOW
+    start_key = int(start_time.strftime('%Y%m%d%H%M%S'))
     # Construct the find query payload.
     # We ask for all studies and filter by the precise time window in the code below.
+    # The window is matched against LastUpdate (when Orthanc received the study),
+    # which /tools/find cannot filter on, so it is not pushed into the query.
+    # 'Expand' returns each study's tags and LastUpdate inline, so no
+    # follow-up request per candidate is needed.
     query = {
         'Level': 'Study',
+        'Expand': True,
         'Query': {}
     }
     new_studies = []
     try:
-        # Use post_tools_find to query the Orthanc database directly
-        study_ids = client.post_tools_find(query)
-        print(f"Found {len(study_ids)} candidate studies.")
-        for study_id in study_ids:
-            # Get the full study information
-            study = Study(study_id, client)
-            study_info = study.get_main_information()
+        # Query the Orthanc database directly, filtering studies as they stream in
+        candidate_count = 0
+        for study_info in _iter_find(client, query):
+            candidate_count += 1
+            study_id = study_info['ID']
             study_uid = study_info.get('MainDicomTags', {}).get('StudyInstanceUID')
             if not study_uid:
                 print(f"Warning: Found a study (ID: {study_id}) with no StudyInstanceUID. Skipping.")
                 continue
-            # Skip if we have already processed this study
-            if study_uid in processed_uids:
-                continue
             # Now, check if the study is within our precise time window by
-            # checking the LastUpdate field.
+            # checking the LastUpdate field. This only looks at the row already
+            # in hand, so it runs before the processed-study database lookup.
             last_update_str = study_info.get('LastUpdate')
             try:
-                # Orthanc's LastUpdate is in ISO 8601 format (e.g., '20230401T123000')
-                # It needs to be parsed into a timezone-aware datetime object.
-                last_update = datetime.strptime(last_update_str, '%Y%m%dT%H%M%S')
-                if last_update >= start_time:
-                    print(f"  -> Found new study: {study_uid} from {last_update}")
-                    new_studies.append({'ID': study_id})
-            except (ValueError, TypeError):
+                # Orthanc's LastUpdate is in ISO 8601 format (e.g., '20230401T123000').
+                # Dropping the 'T' gives a fixed-width YYYYMMDDHHMMSS integer that
+                # compares in the same order as the timestamp, without strptime.
+                if len(last_update_str) != 15 or last_update_str[8] != 'T':
+                    raise ValueError(last_update_str)
+                last_update_key = int(last_update_str.replace('T', ''))
+            except (ValueError, TypeError, AttributeError):
                 print(f"Warning: Could not parse LastUpdate for study {study_uid} ('{last_update_str}'). Skipping.")
                 continue
+            if last_update_key < start_key:
+                continue
+            # Skip if we have already processed this study
+            if study_uid in processed_uids:
+                continue
+            print(f"  -> Found new study: {study_uid} from {last_update_str}")
+            new_studies.append({'ID': study_id, 'StudyInstanceUID': study_uid})
+        print(f"Checked {candidate_count} candidate studies.")
     except Exception as e:
         print(f"Error during study query: {e}", file=sys.stderr)
     return new_studies
 
-def retrieve_and_save_study(client, study_orthanc_id):
+def _extract_member(zf, info, study_path):
+    """
+    Writes one archive member to <study_path>/<SOPInstanceUID>.dcm through a
+    WRITE_BUFFER_SIZE buffer, so the data reaches the kernel in large chunks.
+    The member's path inside the archive is never used on disk: it contains
+    patient names and restarts its numbering in every series.
+    """
+    with zf.open(info) as src:
+        header = pydicom.dcmread(src, stop_before_pixels=True, specific_tags=['SOPInstanceUID'])
+    instance_uid = str(header.get('SOPInstanceUID', ''))
+    if not instance_uid or not all(c.isdigit() or c == '.' for c in instance_uid):
+        raise ValueError(f"Archive member '{info.filename}' has no valid SOPInstanceUID")
+    instance_path = os.path.join(study_path, f"{instance_uid}.dcm")
+    with zf.open(info) as src, open(instance_path, 'wb', buffering=WRITE_BUFFER_SIZE) as dst:
+        shutil.copyfileobj(src, dst, WRITE_BUFFER_SIZE)
+
+def retrieve_and_save_study(client, study_orthanc_id, study_uid):
     """
     Retrieves a study's DICOM instances and saves them locally.
+    The StudyInstanceUID is passed in from the query results so the study's
+    main information is not fetched a second time.
     """
     try:
-        study = Study(study_orthanc_id, client)
-        study_uid = study.get_main_information().get('MainDicomTags', {}).get('StudyInstanceUID')
-        
         print(f"Retrieving study {study_uid} (Orthanc ID: {study_orthanc_id})")
 
         study_path = os.path.join(DOWNLOAD_DIR, study_uid)
         os.makedirs(study_path, exist_ok=True)
 
-        instance_count = 0
-        for series in study.series:
-            for instance in series.instances:
-                dicom_file_bytes = instance.get_dicom_file_content()
-                instance_filename = f"{instance.uid}.dcm"
-                instance_path = os.path.join(study_path, instance_filename)
-                with open(instance_path, 'wb') as f:
-                    f.write(dicom_file_bytes)
-                instance_count += 1
+        # Fetch the whole study as a single ZIP archive rather than issuing
+        # one request per instance. The archive is streamed to a temporary
+        # file instead of being held in memory as one large bytes object.
+        with tempfile.TemporaryFile(dir=DOWNLOAD_DIR) as archive_file:
+            archive_url = f"{ORTHANC_URL}/studies/{study_orthanc_id}/archive"
+            with client.stream('GET', archive_url) as response:
+                response.raise_for_status()
+                for chunk in response.iter_bytes(chunk_size=WRITE_BUFFER_SIZE):
+                    archive_file.write(chunk)
+            archive_file.seek(0)
+
+            with zipfile.ZipFile(archive_file) as zf:
+                members = [info for info in zf.infolist() if not info.is_dir()]
+                # Members are stored as separate DEFLATE streams. ZipFile
+                # serializes only the raw reads from the shared file, so the
+                # decompression and the writes run in parallel across threads.
+                with ThreadPoolExecutor(max_workers=EXTRACT_WORKERS) as pool:
+                    list(pool.map(lambda info: _extract_member(zf, info, study_path), members))
+        instance_count = len(members)
         
         print(f"Successfully saved {instance_count} instances to {study_path}")
         return study_uid
@@ -121,10 +218,20 @@ def main():
     os.makedirs(DOWNLOAD_DIR, exist_ok=True)
     
     processed_uids = load_processed_uids()
-    print(f"Loaded {len(processed_uids)} previously processed study UIDs.")
+    print(f"Using processed-study database {PROCESSED_DB_FILE}.")
 
+    client = None
     try:
-        client = Orthanc(ORTHANC_URL, username=ORTHANC_USERNAME, password=ORTHANC_PASSWORD)
+        # pyorthanc's Orthanc is an httpx.Client; one client with a keep-alive
+        # pool is shared by the query and every archive download, so TCP
+        # connections are reused instead of re-established per request.
+        client = Orthanc(
+            ORTHANC_URL,
+            username=ORTHANC_USERNAME,
+            password=ORTHANC_PASSWORD,
+            limits=httpx.Limits(max_keepalive_connections=64, max_connections=64),
+            timeout=httpx.Timeout(30.0),
+        )
         print(f"Successfully connected to Orthanc at {ORTHANC_URL}")
 
         new_studies_to_process = query_for_new_studies(client, processed_uids)
@@ -135,13 +242,17 @@ def main():
 
         print(f"\nBeginning retrieval of {len(new_studies_to_process)} new studies...")
 
+        completed_count = 0
         for study_data in new_studies_to_process:
             orthanc_id = study_data['ID']
             
-            retrieved_study_uid = retrieve_and_save_study(client, orthanc_id)
+            retrieved_study_uid = retrieve_and_save_study(client, orthanc_id, study_data['StudyInstanceUID'])
 
             if retrieved_study_uid:
-                save_processed_uid(retrieved_study_uid)
+                processed_uids.add(retrieved_study_uid)
+                completed_count += 1
+                if completed_count % PROCESSED_COMMIT_INTERVAL == 0:
+                    processed_uids.commit()
                 print(f"Successfully processed and marked study {retrieved_study_uid} as complete.")
                 print("-" * 20)
 
@@ -151,6 +262,11 @@ def main():
     except Exception as e:
         print(f"An unexpected error of type {type(e).__name__} occurred: {e}", file=sys.stderr)
         sys.exit(1)
+    finally:
+        if client is not None:
+            client.close()
+        # Commit any completions since the last batch.
+        processed_uids.close()
 
 if __name__ == '__main__':
     main()
@@ -1,9 +1,26 @@
 import os
 import argparse
+import numpy as np
 import pydicom
 from PIL import Image
 import io
 import base64
+import functools
+import threading
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+
+try:
+    from pybase64 import b64encode_as_string
+except ImportError:
+    # pybase64 is optional; fall back to the (slower) standard library encoder.
+    def b64encode_as_string(data):
+        return base64.b64encode(data).decode("ascii")
+
+try:
+    from numba import njit
+except ImportError:
+    # Numba is optional; without it all images use the NumPy normalization path.
+    njit = None
 
 # --- Provider-Specific Imports ---
 # These are imported dynamically based on the user's choice.
@@ -11,24 +28,79 @@ import base64
 # --- Configuration ---
 PROCESSED_REPORTS_DIR = "processed_reports"
 
+# Data elements needed to decode pixel data. Everything else in the dataset is
+# skipped while parsing; the file meta (incl. TransferSyntaxUID) is always read.
+PIXEL_TAGS = [
+    "SamplesPerPixel", "PhotometricInterpretation", "PlanarConfiguration",
+    "NumberOfFrames", "Rows", "Columns", "BitsAllocated", "BitsStored",
+    "HighBit", "PixelRepresentation", "PixelData",
+]
+
+# Image encoding sent to each provider. Remote providers get JPEG, which is
+# much cheaper to encode than PNG; the local Hugging Face path keeps lossless PNG.
+PROVIDER_IMAGE_FORMATS = {"ollama": "JPEG", "huggingface": "PNG", "cohere": "JPEG"}
+
 # --- Function Definitions ---
 
-def convert_dicom_to_png(dicom_path):
-    """Converts a DICOM file to a PNG image."""
+if njit is not None:
+    # Single-threaded on purpose: files are already converted in parallel by
+    # the process pool in main(), one worker per CPU.
+    @njit(fastmath=True, boundscheck=False)
+    def _norm_16bit_to_u8(src, dst):
+        """
+        Scales a flat 16-bit (uint16 or int16) array into a flat uint8 array.
+        Finds the min and max, then shifts, scales and casts each pixel in a
+        single compiled loop, with no intermediate arrays.
+        """
+        mn = src.min()
+        mx = src.max()
+        scale = np.float32(255.0) / np.float32(max(mx - mn, 1))
+        for i in range(src.size):
+            dst[i] = np.uint8(np.float32(src[i] - mn) * scale)
+else:
+    _norm_16bit_to_u8 = None
+
+# Output buffer reused across files converted in the same process.
+_u8_buffer = np.empty(0, dtype=np.uint8)
+
+def _u8_output(shape):
+    """Returns a uint8 array of the given shape backed by the reusable buffer."""
+    global _u8_buffer
+    size = int(np.prod(shape))
+    if _u8_buffer.size < size:
+        _u8_buffer = np.empty(size, dtype=np.uint8)
+    return _u8_buffer[:size].reshape(shape)
+
+def convert_dicom_to_image(dicom_path, encode_format="PNG"):
+    """Converts a DICOM file to an encoded image (PNG by default, or JPEG)."""
     try:
-        dicom_file = pydicom.dcmread(dicom_path)
-        image_data = dicom_file.pixel_array
+        dicom_file = pydicom.dcmread(dicom_path, specific_tags=PIXEL_TAGS)
+        pixels = dicom_file.pixel_array
         
-        # Normalize pixel values for image conversion
-        image_data = image_data - image_data.min()
-        image_data = image_data / image_data.max()
-        image_data = (image_data * 255).astype('uint8')
+        # Normalize pixel values for image conversion.
+        if _norm_16bit_to_u8 is not None and pixels.dtype in (np.uint16, np.int16):
+            # 16-bit data: unsigned (typical MR) or signed (CT, PixelRepresentation=1).
+            image_data = _u8_output(pixels.shape)
+            _norm_16bit_to_u8(np.ascontiguousarray(pixels).reshape(-1), image_data.reshape(-1))
+        else:
+            # The shift is done in a single float32 buffer and the scaled result
+            # is cast straight into the uint8 output, avoiding a chain of
+            # full-size float64 temporaries.
+            lo, hi = pixels.min(), pixels.max()
+            scale = np.float32(255.0 / max(float(hi) - float(lo), 1.0))
+            shifted = np.subtract(pixels, lo, dtype=np.float32)
+            image_data = np.empty(pixels.shape, dtype=np.uint8)
+            np.multiply(shifted, scale, out=image_data, casting='unsafe')
         
         image = Image.fromarray(image_data)
         
         # Convert image to a byte stream
         img_byte_arr = io.BytesIO()
-        image.save(img_byte_arr, format='PNG')
+        if encode_format == "JPEG":
+            image.save(img_byte_arr, format='JPEG', quality=92, optimize=False)
+        else:
+            # Fastest zlib level; the bytes are decoded again right away.
+            image.save(img_byte_arr, format='PNG', compress_level=1)
         return img_byte_arr.getvalue()
 
     except Exception as e:
@@ -39,14 +111,15 @@ def generate_report_with_ollama(image_bytes, model_name):
     """Generates a medical report from an image using an Ollama model."""
     try:
         import ollama
-        image_base64 = base64.b64encode(image_bytes).decode('utf-8')
+        # The Ollama client accepts raw image bytes and base64-encodes them itself
+        # for the JSON request, so this only moves the encoding, it does not avoid it.
         response = ollama.chat(
             model=model_name,
             messages=[
                 {
                     'role': 'user',
                     'content': 'Generate a detailed medical report for this image.',
-                    'images': [image_base64]
+                    'images': [image_bytes]
                 }
             ]
         )
@@ -55,39 +128,77 @@ def generate_report_with_ollama(image_bytes, model_name):
         print(f"Error with Ollama: {e}")
         return None
 
-def generate_report_with_huggingface(image_bytes, model_name):
-    """Generates a medical report from an image using a Hugging Face model."""
+@functools.lru_cache(maxsize=2)
+def _hf_load(model_name, quantize="none"):
+    """
+    Loads a Hugging Face processor and model once and keeps them for later files.
+    quantize selects bitsandbytes weight quantization: "none" (bf16), "8bit" or "4bit" (NF4).
+    """
+    import torch
+    from transformers import AutoModelForImageTextToText, AutoProcessor, BitsAndBytesConfig
+
+    quantization_config = None
+    if quantize == "4bit":
+        quantization_config = BitsAndBytesConfig(
+            load_in_4bit=True,
+            bnb_4bit_compute_dtype=torch.bfloat16,
+            bnb_4bit_quant_type="nf4"
+        )
+    elif quantize == "8bit":
+        quantization_config = BitsAndBytesConfig(load_in_8bit=True)
+
+    processor = AutoProcessor.from_pretrained(model_name)
+    model = AutoModelForImageTextToText.from_pretrained(
+        model_name,
+        torch_dtype=torch.bfloat16,
+        device_map="auto",
+        quantization_config=quantization_config
+    )
+    # Decoder-only models must be padded on the left for batched generation.
+    processor.tokenizer.padding_side = "left"
+    # Reuse one preallocated KV cache across batches.
+    model.generation_config.cache_implementation = "static"
+    return processor, model
+
+def generate_report_with_huggingface(images, model_name, quantize="none"):
+    """Generates medical reports for a batch of images using a Hugging Face model."""
     try:
         import torch
-        from transformers import AutoModelForCausalLM, AutoTokenizer
-        
-        tokenizer = AutoTokenizer.from_pretrained(model_name)
-        model = AutoModelForCausalLM.from_pretrained(
-            model_name,
-            torch_dtype=torch.bfloat16,
-            device_map="auto"
-        )
+        processor, model = _hf_load(model_name, quantize)
         
-        image = Image.open(io.BytesIO(image_bytes))
-        prompt = tokenizer.from_list_of_messages([
-            {"role": "user", "content": [image, "Generate a detailed medical report for this image."]}
-        ])
+        conversations = [
+            [{"role": "user", "content": [
+                {"type": "image", "image": Image.open(io.BytesIO(image_bytes)).convert("RGB")},
+                {"type": "text", "text": "Generate a detailed medical report for this image."}
+            ]}]
+            for image_bytes in images
+        ]
         
-        inputs = prompt.to(model.device)
-        generation = model.generate(**inputs, max_new_tokens=1024)
-        report = tokenizer.decode(generation[0], skip_special_tokens=True)
-        return report
+        # One processor call tokenizes, pads and stacks the text and image
+        # tensors of the whole batch.
+        inputs = processor.apply_chat_template(
+            conversations,
+            add_generation_prompt=True,
+            tokenize=True,
+            return_dict=True,
+            padding=True,
+            return_tensors="pt"
+        ).to(model.device, dtype=torch.bfloat16)
+        generation = model.generate(**inputs, max_new_tokens=1024, do_sample=False, num_beams=1, use_cache=True)
+        # Keep only the generated tokens, dropping the (left-padded) prompt.
+        generation = generation[:, inputs["input_ids"].shape[1]:]
+        return processor.batch_decode(generation, skip_special_tokens=True)
     except Exception as e:
         print(f"Error with Hugging Face: {e}")
-        return None
+        return [None] * len(images)
 
-def generate_report_with_cohere(image_bytes, model_name):
+def generate_report_with_cohere(image_bytes, model_name, image_format="JPEG"):
     """Generates a medical report from an image using a Cohere model."""
     try:
         import cohere
         co = cohere.Client(os.environ.get("COHERE_API_KEY"))
         
-        image_base64 = base64.b64encode(image_bytes).decode("utf-8")
+        image_base64 = b64encode_as_string(image_bytes)
         response = co.chat(
             model=model_name,
             messages=[
@@ -95,7 +206,7 @@ def generate_report_with_cohere(image_bytes, model_name):
                     "role": "User",
                     "content": [
                         {"type": "text", "text": "Generate a detailed medical report for this image."},
-                        {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{image_base64}"}}
+                        {"type": "image_url", "image_url": {"url": f"data:image/{image_format.lower()};base64,{image_base64}"}}
                     ]
                 }
             ]
@@ -105,20 +216,56 @@ def generate_report_with_cohere(image_bytes, model_name):
         print(f"Error with Cohere: {e}")
         return None
 
+def generate_reports(provider, images, model_name, quantize="none"):
+    """Generates medical reports for a batch of encoded images with the selected provider."""
+    if provider == "huggingface":
+        return generate_report_with_huggingface(images, model_name, quantize)
+    elif provider == "ollama":
+        return [generate_report_with_ollama(image_bytes, model_name) for image_bytes in images]
+    elif provider == "cohere":
+        return [generate_report_with_cohere(image_bytes, model_name, PROVIDER_IMAGE_FORMATS[provider]) for image_bytes in images]
+    return [None] * len(images)
+
+def save_reports(filenames, future):
+    """Writes the reports produced by a finished generation future to disk."""
+    for filename, report in zip(filenames, future.result()):
+        if not report:
+            print(f"Failed to generate report for {filename}")
+            continue
+
+        report_filename = f"{os.path.splitext(filename)[0]}.txt"
+        report_path = os.path.join(PROCESSED_REPORTS_DIR, report_filename)
+        
+        with open(report_path, "w") as f:
+            f.write(report)
+            
+        print(f"Report saved to {report_path}")
+
 # --- Main Execution ---
 
+def positive_int(value):
+    """argparse type accepting only integers greater than zero."""
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be a positive integer, got {value}")
+    return number
+
 def main():
     # --- Argument Parsing ---
     parser = argparse.ArgumentParser(description="Process DICOM files and generate medical reports.")
     parser.add_argument("dicom_dir", help="Directory containing DICOM files to process.")
     parser.add_argument("--provider", choices=["ollama", "huggingface", "cohere"], default="ollama", help="The AI provider to use.")
     parser.add_argument("--model", help="The name of the model to use.")
+    parser.add_argument("--workers", type=positive_int, default=os.cpu_count() or 1, help="Number of processes used to decode DICOM files.")
+    parser.add_argument("--llm-workers", type=positive_int, default=8, help="Number of concurrent report requests (always 1 for huggingface).")
+    parser.add_argument("--quantize", choices=["none", "8bit", "4bit"], default="none", help="Weight quantization for the Hugging Face model.")
+    parser.add_argument("--batch-size", type=positive_int, default=8, help="Number of images per generate() call (huggingface only).")
     args = parser.parse_args()
 
     # --- Model Name Validation ---
     if not args.model:
         if args.provider == "huggingface":
-            args.model = "google/medgemma-1.0-7b-it"
+            args.model = "google/medgemma-4b-it"
         elif args.provider == "cohere":
             args.model = "command-r-plus" 
         else: # ollama
@@ -129,37 +276,71 @@ def main():
         os.makedirs(PROCESSED_REPORTS_DIR)
 
     # --- File Processing ---
-    for filename in os.listdir(args.dicom_dir):
-        dicom_path = os.path.join(args.dicom_dir, filename)
-        
-        if not os.path.isfile(dicom_path):
-            continue
+    # DICOM decoding is CPU-bound and runs in a process pool; report generation
+    # is I/O-bound and runs in a thread pool, so model latency for one file
+    # overlaps with decoding of the others. The local Hugging Face model is
+    # shared, so its requests are serialized and images are batched instead.
+    filenames = [
+        filename for filename in os.listdir(args.dicom_dir)
+        if os.path.isfile(os.path.join(args.dicom_dir, filename))
+    ]
+    image_format = PROVIDER_IMAGE_FORMATS[args.provider]
+    llm_workers = 1 if args.provider == "huggingface" else args.llm_workers
+    batch_size = args.batch_size if args.provider == "huggingface" else 1
 
-        print(f"Processing {filename} with {args.provider}...")
-        
-        image_bytes = convert_dicom_to_png(dicom_path)
-        if not image_bytes:
-            continue
-            
-        report = None
-        if args.provider == "ollama":
-            report = generate_report_with_ollama(image_bytes, args.model)
-        elif args.provider == "huggingface":
-            report = generate_report_with_huggingface(image_bytes, args.model)
-        elif args.provider == "cohere":
-            report = generate_report_with_cohere(image_bytes, args.model)
-            
-        if not report:
-            print(f"Failed to generate report for {filename}")
-            continue
-            
-        report_filename = f"{os.path.splitext(filename)[0]}.txt"
-        report_path = os.path.join(PROCESSED_REPORTS_DIR, report_filename)
-        
-        with open(report_path, "w") as f:
-            f.write(report)
-            
-        print(f"Report saved to {report_path}")
+    # Each file holds a slot from submission to the decode pool until its
+    # report is written, so at most this many encoded images are in memory.
+    in_flight = threading.BoundedSemaphore(args.workers + llm_workers * batch_size)
+
+    with ProcessPoolExecutor(max_workers=args.workers) as decode_pool, \
+            ThreadPoolExecutor(max_workers=llm_workers) as llm_pool:
+        remaining = iter(filenames)
+        exhausted = False
+        conversions = {}
+        batch_filenames, batch_images = [], []
+
+        def finish(filenames, future):
+            try:
+                save_reports(filenames, future)
+            finally:
+                for _ in filenames:
+                    in_flight.release()
+
+        def flush():
+            generation = llm_pool.submit(generate_reports, args.provider, batch_images[:], args.model, args.quantize)
+            generation.add_done_callback(functools.partial(finish, batch_filenames[:]))
+            batch_filenames.clear()
+            batch_images.clear()
+
+        while True:
+            # Top up the decode pool while slots are free. If nothing is being
+            # decoded, block until a report finishes and frees a slot.
+            while not exhausted and in_flight.acquire(blocking=not conversions):
+                filename = next(remaining, None)
+                if filename is None:
+                    in_flight.release()
+                    exhausted = True
+                    break
+                conversion = decode_pool.submit(convert_dicom_to_image, os.path.join(args.dicom_dir, filename), image_format)
+                conversions[conversion] = filename
+            if not conversions:
+                break
+
+            done, _ = wait(conversions, return_when=FIRST_COMPLETED)
+            for conversion in done:
+                filename = conversions.pop(conversion)
+                image_bytes = conversion.result()
+                if not image_bytes:
+                    in_flight.release()
+                    continue
+
+                print(f"Processing {filename} with {args.provider}...")
+                batch_filenames.append(filename)
+                batch_images.append(image_bytes)
+                if len(batch_images) >= batch_size:
+                    flush()
+        if batch_images:
+            flush()
 
 if __name__ == "__main__":
     main()